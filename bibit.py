@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import os, requests, json, time
+import os, httpx, orjson, time, base64, zstandard
+from types import MappingProxyType
 from Crypto.Cipher import AES
 
 
@@ -18,19 +19,75 @@ class StoreNotInitializedError(Exception):
 
 
 class JSONFileStorage:
+    buffer_size = 64 * 1024
+
     def __init__(self, filename):
         self.filename = filename
 
     def load(self):
         try:
-            with open(self.filename, "r") as fd:
-                return json.load(fd)
+            with open(self.filename, "rb", buffering=self.buffer_size) as fd:
+                return orjson.loads(fd.read())
         except FileNotFoundError:
             raise StoreNotInitializedError
 
     def dump(self, content):
-        with open(self.filename, "w") as fd:
-            json.dump(content, fd)
+        with open(self.filename, "wb", buffering=self.buffer_size) as fd:
+            fd.write(orjson.dumps(content))
+
+
+COMPRESSED_FILE_SUFFIX = ".zst"
+
+
+class NDJSONFileStorage(JSONFileStorage):
+    def load(self):
+        try:
+            with open(self.filename, "rb", buffering=self.buffer_size) as fd:
+                return [orjson.loads(line) for line in fd if line.strip()]
+        except FileNotFoundError:
+            raise StoreNotInitializedError
+
+    def dump(self, content):
+        with open(self.filename, "wb", buffering=self.buffer_size) as fd:
+            for record in content:
+                fd.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+
+    def load_last(self):
+        try:
+            with open(self.filename, "rb") as fd:
+                # read backwards from EOF until the tail holds a complete last line
+                pos = fd.seek(0, os.SEEK_END)
+                tail = b''
+                while pos > 0 and b'\n' not in tail.rstrip():
+                    step = min(self.buffer_size, pos)
+                    pos -= step
+                    fd.seek(pos)
+                    tail = fd.read(step) + tail
+        except FileNotFoundError:
+            raise StoreNotInitializedError
+
+        last_line = tail.rstrip().rpartition(b'\n')[2]
+        return orjson.loads(last_line) if last_line.strip() else None
+
+    def count(self):
+        try:
+            with open(self.filename, "rb", buffering=self.buffer_size) as fd:
+                # same rule as load(), blank lines are not records
+                return sum(1 for line in fd if line.strip())
+        except FileNotFoundError:
+            raise StoreNotInitializedError
+
+    def append(self, record):
+        with open(self.filename, "ab") as fd:
+            fd.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+
+    def compress(self, level=3):
+        filename = f"{self.filename}{COMPRESSED_FILE_SUFFIX}"
+        # never overwrite an archive that is already there
+        with open(self.filename, "rb") as src, open(filename, "xb", buffering=self.buffer_size) as dst:
+            zstandard.ZstdCompressor(level=level).copy_stream(src, dst)
+
+        os.remove(self.filename)
 
 
 class SecretStore:
@@ -57,12 +114,15 @@ class SecretStore:
 
    
 class RollingJSONFileRepository:
+    file_extension = "ndjson"
+    legacy_file_extension = "json"
+
     def __init__(self, directory, file_prefix):
         self.directory = directory
         self.file_prefix = file_prefix
 
     def _get_filename(self, idx):
-        return os.path.join(self.directory, f"{self.file_prefix}.{idx}.json")
+        return os.path.join(self.directory, f"{self.file_prefix}.{idx}.{self.file_extension}")
 
     def init(self):
         try:
@@ -70,18 +130,52 @@ class RollingJSONFileRepository:
         except OSError:
             pass
 
-        self.files = os.listdir(self.directory)
-        
-        # get the latest index
-        self._last_idx = 1
-        for f in self.files:
-            _, idx, _ = f.split('.')
-
-            idx = int(idx)
-            if idx > self._last_idx:
-                self._last_idx = idx
+        prefix = f"{self.file_prefix}."
+        suffix = f".{self.file_extension}"
+
+        self._upgrade_legacy_files(prefix, suffix)
+
+        # get the latest index, rolled files are compressed and never reopened for writing
+        self._last_idx = 0
+        last_is_compressed = False
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name = entry.name
+                compressed = name.endswith(COMPRESSED_FILE_SUFFIX)
+                if compressed:
+                    name = name[:-len(COMPRESSED_FILE_SUFFIX)]
+                if not name.startswith(prefix) or not name.endswith(suffix):
+                    continue
+
+                idx = name[:-len(suffix)].rpartition('.')[2]
+                if not idx.isdigit():
+                    continue
+
+                idx = int(idx)
+                if idx > self._last_idx or (idx == self._last_idx and not compressed):
+                    self._last_idx = idx
+                    last_is_compressed = compressed
+
+        if not self._last_idx:
+            self._last_idx = 1
+        elif last_is_compressed:
+            self._last_idx += 1
+
+    def _upgrade_legacy_files(self, prefix, suffix):
+        # history files used to hold a single JSON array, rewrite them once as NDJSON
+        legacy_suffix = f".{self.legacy_file_extension}"
+        with os.scandir(self.directory) as entries:
+            legacy_paths = [
+                entry.path for entry in entries
+                if entry.name.startswith(prefix) and entry.name.endswith(legacy_suffix)
+                and not entry.name.endswith(suffix)
+            ]
+
+        for path in legacy_paths:
+            records = JSONFileStorage(path).load()
+            NDJSONFileStorage(path[:-len(legacy_suffix)] + suffix).dump(records)
+            os.remove(path)
 
-    
     def get_latest_filename(self):
         return self._get_filename(self._last_idx)
     
@@ -96,27 +190,58 @@ class PortofolioHistoryStore:
 
     def init(self):
         try:
-            self.history = self.storage.load()
+            last = self.storage.load_last()
         except StoreNotInitializedError:
-            self.history = []
+            last = None
+
+        # counting reads the whole file, only do it once a rollover check needs it
+        self._count = None
+
+        # the full history is only decoded when something asks for it
+        self._history = None
+        self._last_map = self._build_map(last['portofolios']) if last else {}
+
+    @property
+    def history(self):
+        if self._history is None:
+            try:
+                self._history = self.storage.load()
+            except StoreNotInitializedError:
+                self._history = []
+        return self._history
+
+    def _build_map(self, snapshot):
+        # snapshots are stored already indexed by id, older ones are plain lists
+        if isinstance(snapshot, dict):
+            return snapshot
+        return {str(porto_item['id']): porto_item for porto_item in snapshot}
 
     def save(self):
         self.storage.dump(self.history)
 
     def add(self, snapshot):
-        self.history.append({"timestamp": int(time.time()), "portofolios": snapshot})
-        self.save()
-
-    def get_last(self):
-        try:
-            last = self.history[-1]
-            return last['portofolios']
-        except IndexError:
-            return []
+        record = {"timestamp": time.time_ns() // 1_000_000_000, "portofolios": snapshot}
+        if self._history is not None:
+            self._history.append(record)
+        self.storage.append(record)
+        if self._count is not None:
+            self._count += 1
+        self._last_map = self._build_map(snapshot)
+
+    def count(self):
+        if self._count is None:
+            try:
+                self._count = self.storage.count()
+            except StoreNotInitializedError:
+                self._count = 0
+        return self._count
+
+    def get_last_map(self):
+        return self._last_map
 
     
 class RollingPortofolioHistoryStore:
-    portofolio_history_storage_klass = JSONFileStorage
+    portofolio_history_storage_klass = NDJSONFileStorage
     portofolio_history_store_klass = PortofolioHistoryStore
     max_portofolio = 100
     
@@ -124,14 +249,16 @@ class RollingPortofolioHistoryStore:
         self.file_repository = file_repository
 
     def add(self, snapshot):
-        if len(self._store.history) > self.max_portofolio:
+        if self._store.count() > self.max_portofolio:
+            # the closed file won't be appended to again, keep it compressed
+            self._store.storage.compress()
             new_filename = self.file_repository.new_file()
             self._init_inner_store(new_filename)
         
         self._store.add(snapshot)
 
-    def get_last(self):
-        return self._store.get_last()
+    def get_last_map(self):
+        return self._store.get_last_map()
 
     def save(self):
         self._store.save()
@@ -148,31 +275,38 @@ class RollingPortofolioHistoryStore:
 
 
 
+_DEFAULT_HEADERS = MappingProxyType({
+    'authority': 'api.bibit.id',
+    'sec-ch-ua': '"Google Chrome";v="87", " Not;A Brand";v="99", "Chromium";v="87"',
+    'accept': 'application/json, text/plain, */*',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36',
+    'x-platform': 'web',
+    'sec-ch-ua-mobile': '?0',
+    'origin': 'https://app.bibit.id',
+    'sec-fetch-site': 'same-site',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-dest': 'empty',
+    'referer': 'https://app.bibit.id/',
+    'accept-language': 'en-US,en;q=0.9',
+})
+
+
 class BibitAPI:
+    token_expiry_margin = 60
+    timeout = 10.0
+
     def __init__(self, secret_storage, decrypter):
         self.secret_storage = secret_storage
         self.decrypter = decrypter
+
+        self._client = httpx.Client(http2=True, headers=_DEFAULT_HEADERS, timeout=self.timeout, follow_redirects=True)
     
     def _request(self, method, endpoint, data={}, allow_fail=True):
-        headers = {
-            'authority': 'api.bibit.id',
-            'sec-ch-ua': '"Google Chrome";v="87", " Not;A Brand";v="99", "Chromium";v="87"',
-            'accept': 'application/json, text/plain, */*',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36',
-            'x-platform': 'web',
-            'sec-ch-ua-mobile': '?0',
-            'origin': 'https://app.bibit.id',
-            'sec-fetch-site': 'same-site',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-dest': 'empty',
-            'referer': 'https://app.bibit.id/',
-            'accept-language': 'en-US,en;q=0.9',
-        }
-
+        headers = None
         if self.secret_storage.access_token:
-            headers['authorization'] = f'Bearer {self.secret_storage.access_token}'
+            headers = {'authorization': f'Bearer {self.secret_storage.access_token}'}
 
-        res = requests.request(method.upper(), f'https://api.bibit.id{endpoint}', json=data, headers=headers)
+        res = self._client.request(method.upper(), f'https://api.bibit.id{endpoint}', json=data, headers=headers)
         if not allow_fail:
             res.raise_for_status()
 
@@ -188,12 +322,24 @@ class BibitAPI:
             allow_fail=False,
         )
 
-        token = res.json()['data']['token']
+        token = orjson.loads(res.content)['data']['token']
         self.secret_storage.access_token = token['access_token']
         self.secret_storage.refresh_token = token['refresh_token']
         self.secret_storage.save()
 
+    def _token_expires_soon(self):
+        # access tokens are JWTs, peek at the exp claim without verifying it
+        try:
+            payload = self.secret_storage.access_token.split('.')[1]
+            claims = orjson.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+            return claims['exp'] - time.time() < self.token_expiry_margin
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+            return False
+
     def request(self, method, url, data={}):
+        if self._token_expires_soon():
+            self._refresh_token()
+
         res = self._request(method, url, data)
         if res.status_code == 200:
             return res
@@ -205,29 +351,32 @@ class BibitAPI:
         res.raise_for_status()
          
     def get_portofolio(self):
-        return self.request('GET', "/portfolio").json()
+        return orjson.loads(self.request('GET', "/portfolio").content)
 
     def get_product(self, id):
-        res = self.request('GET', f"/products/{id}").json()
+        res = orjson.loads(self.request('GET', f"/products/{id}").content)
         if 'data' in res:
-            res['data'] = json.loads(self.decrypter.decrypt(res['data']))
+            res['data'] = orjson.loads(self.decrypter.decrypt(res['data']))
         return res
 
     def get_portofolio_category(self, id):
         return self.request('GET', f"/portofolio/category/{id}")
         
 
+_MARKDOWN_V2_ESCAPE_TABLE = str.maketrans({c: f'\\{c}' for c in '.[]-|'})
+
+
 class TelegramAPI:
+    timeout = 10.0
+
     def __init__(self, secret_storage):
         self.secret_storage = secret_storage
+        self._client = httpx.Client(http2=True, timeout=self.timeout, follow_redirects=True)
 
     def send_message(self, content):
-        to_replace = ['.', '[', ']', '-', '|']
-        safe_msg = content
-        for c in to_replace:
-            safe_msg = safe_msg.replace(c, f'\{c}')
+        safe_msg = content.translate(_MARKDOWN_V2_ESCAPE_TABLE)
 
-        requests.post(
+        self._client.post(
             f'https://api.telegram.org/bot{self.secret_storage.telegram_token}/sendMessage',
             json={
                 "chat_id": self.secret_storage.telegram_chat_id, 
@@ -237,73 +386,80 @@ class TelegramAPI:
         ).raise_for_status()
 
 
+# indexed by the sign of the change plus one: down, flat, up
+_CHANGE_EMOJIS = ('\U0001F4C9', '\u2b1c', '\U0001F4C8')
+
+# stands in for portofolios missing from the last snapshot
+_EMPTY_PORTO_ITEM = MappingProxyType({"invested": 0, "marketvalue": 0})
+
+
 class BibitNotifyJob:
     def __init__(self, bibit_api, telegram_api, portofolio_history_store):
         self.bibit_api = bibit_api
         self.telegram_api = telegram_api
         self.portofolio_history_store = portofolio_history_store 
 
-    def _clean_porto_item(self, porto_item):
-        fields = ["id", "invested", "marketvalue", "name"]
-        return {field: porto_item[field] for field in fields}
-    
-    def _clean_porto(self, porto):
-        return list(map(self._clean_porto_item, porto['result']))
-
-    def _build_porto_map(self, porto):
-        return {porto_item['id']: porto_item for porto_item in porto}
+    def _clean_and_index(self, porto):
+        # keyed by the stringified id so the map survives a JSON round trip unchanged
+        return {
+            str(porto_item['id']): {
+                "id": porto_item['id'],
+                "invested": porto_item['invested'],
+                "marketvalue": porto_item['marketvalue'],
+                "name": porto_item['name'],
+            }
+            for porto_item in porto['result']
+        }
 
     def _format_currency(self, num):
-        rounded = round(num)
-        return f"{rounded:,}"
-
-    def _format_message(self, name, change_percentage, total, profit):
-        if change_percentage > 1e-9:
-            emoji = '\U0001F4C8'
-        elif change_percentage < -1e-9:
-            emoji = '\U0001F4C9'
-        else:
-            emoji = '\u2b1c'
-
-        change_percentage = abs(change_percentage * 100)
+        return format(round(num), ',')
+
+    def _format_message(self, name, change_permille, total, profit):
+        emoji = _CHANGE_EMOJIS[(change_permille > 0) - (change_permille < 0) + 1]
+        change_percentage = abs(change_permille) / 10
         total = self._format_currency(total)
         profit = self._format_currency(profit)
-        return f"{emoji} {change_percentage:.1f} | *{name}*\n{total} [{profit}]\n"
+        return f"{emoji} {change_percentage:.1f} | *{name}*\n{total} [{profit}]"
+
+    def _has_changed(self, porto_map, last_porto_map):
+        for porto_id, porto_item in porto_map.items():
+            if porto_item['invested'] == 0:
+                continue
+
+            last_value = last_porto_map.get(porto_id, _EMPTY_PORTO_ITEM)['marketvalue']
+            if int(porto_item['marketvalue']) != int(last_value):
+                return True
 
-    def _construct_message(self, porto):
-        last_porto = self.portofolio_history_store.get_last()
-        last_porto_map = self._build_porto_map(last_porto)
-        porto_map = self._build_porto_map(porto)
+        return False
+
+    def _construct_message(self, porto_map):
+        last_porto_map = self.portofolio_history_store.get_last_map()
+        if not self._has_changed(porto_map, last_porto_map):
+            return False, ''
 
-        should_send = False
         message_parts = []
-        for porto_id in sorted(porto_map.keys()):
+        for porto_id in sorted(porto_map.keys(), key=lambda porto_id: porto_map[porto_id]['id']):
             porto_item = porto_map[porto_id]
-            last_porto_item = last_porto_map.get(porto_id, {})
-            
-            last_value = last_porto_item.get('marketvalue', 0) 
-            last_profit = last_value - last_porto_item.get('invested', 0)
-
             current_invested = porto_item['invested']
             if current_invested == 0:
                 continue
 
+            last_porto_item = last_porto_map.get(porto_id, _EMPTY_PORTO_ITEM)
+            last_profit = last_porto_item['marketvalue'] - last_porto_item['invested']
+
             current_value = porto_item['marketvalue']
             current_profit = current_value - current_invested
-            change_percentage = 1.0 * (current_profit - last_profit) / current_invested
-
-            if int(current_value) != int(last_value):
-                should_send = True
+            change_permille = round((current_profit - last_profit) * 1000 / current_invested)
 
-            formatted = self._format_message(porto_item['name'], change_percentage, current_value, current_profit)
+            formatted = self._format_message(porto_item['name'], change_permille, current_value, current_profit)
             message_parts.append(formatted)
 
-        return should_send, '\n'.join(message_parts)
+        return True, '\n\n'.join(message_parts)
 
             
     def run(self):
         portofolio = self.bibit_api.get_portofolio()
-        cleaned = self._clean_porto(portofolio['data'])
+        cleaned = self._clean_and_index(portofolio['data'])
         should_send, message = self._construct_message(cleaned)
         if should_send:
             self.telegram_api.send_message(message)